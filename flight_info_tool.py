@@ -16,6 +16,10 @@ _ = load_dotenv(find_dotenv())
 RAPID_API_KEY = os.environ['RAPID_API_KEY']
 RAPID_API_HOST = os.environ['RAPID_API_HOST']
 
+class FlightSearchTimeout(ToolException):
+    """Raised when the flight API doesn't answer within the request timeout."""
+
+
 class FlightInfoInput(BaseModel):
     flight_number: str = Field(description="The flight number in the format of a carrier code followed by a numeric part (e.g., 'AA100').")
     search_date: Optional[datetime] = Field(default=None, description="The date and time to search for the next available fligh")
@@ -24,6 +28,8 @@ class FlightInfoTool(BaseTool):
     name = "flight_info_tool"
     description = "Fetches the next available flight information for a given flight number using the RapidAPI Flight Info API"
     args_schema: Type[BaseModel] = FlightInfoInput
+    request_timeout: Optional[float] = None
+    """Timeout in seconds for the API request (for connecting and for each read), None to wait indefinitely."""
 
     def _run(
         self, flight_number: str, search_date: Optional[datetime] = None, run_manager: Optional[CallbackManagerForToolRun] = None
@@ -63,9 +69,11 @@ class FlightInfoTool(BaseTool):
         
         # Request flight information
         try:
-            response = requests.get(base_url, headers=headers, params=params)
+            response = requests.get(base_url, headers=headers, params=params, timeout=self.request_timeout)
             response.raise_for_status()
             data = response.json()
+        except requests.exceptions.Timeout as e:
+            raise FlightSearchTimeout("The flight search took too long.")
         except requests.exceptions.RequestException as e:
             raise ToolException(f"No flights found for the given flight number.")
         
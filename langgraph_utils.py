@@ -1,4 +1,5 @@
 import os
+import time
 import logging
 from typing import Any, Dict
 
@@ -13,6 +14,22 @@ load_dotenv()
 
 # Environment variables
 LANGUAGE_MODEL = os.getenv("LANGUAGE_MODEL", "gpt-3.5-turbo")
+FLIGHT_INFO_MODEL = os.getenv("FLIGHT_INFO_MODEL", LANGUAGE_MODEL)
+RECOMMENDATION_MODEL = os.getenv("RECOMMENDATION_MODEL", LANGUAGE_MODEL)
+FALLBACK_MODEL = os.getenv("FALLBACK_MODEL")
+# End-to-end latency budget for one recommendation request, in seconds
+LATENCY_BUDGET = float(os.getenv("LATENCY_BUDGET", "30"))
+# Cap on the flight-parsing step, so the rest of the budget is left for the flight search and the recommendations
+FLIGHT_INFO_BUDGET = float(os.getenv("FLIGHT_INFO_BUDGET", "10"))
+# Part of each step's time kept back for the fallback model, in seconds
+FALLBACK_RESERVE = float(os.getenv("FALLBACK_RESERVE", "4"))
+
+if not 0 <= FALLBACK_RESERVE < FLIGHT_INFO_BUDGET <= LATENCY_BUDGET:
+    raise ValueError("Expected 0 <= FALLBACK_RESERVE < FLIGHT_INFO_BUDGET <= LATENCY_BUDGET, got "
+                     f"FALLBACK_RESERVE={FALLBACK_RESERVE}, FLIGHT_INFO_BUDGET={FLIGHT_INFO_BUDGET}, LATENCY_BUDGET={LATENCY_BUDGET}")
+
+# Steps reported in the routing log line, in graph order
+ROUTED_STEPS = ("flight_info", "flight_info_tool", "recommendation")
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -51,8 +68,31 @@ def get_answer_for_recommendation_graph(user_message: str, chat_id: str, poll_da
     Get an answer from the recommendation graph based on user message and poll data.
     """
     logger.info("Getting answer for recommendation graph")
-    llm = ChatOpenAI(model=LANGUAGE_MODEL)
-    recommendation_graph = RecommendationGraph(llm)
+    start_time = time.monotonic()
+    # Retries would run past the deadline, the graph falls back to another model instead
+    flight_info_llm = ChatOpenAI(model=FLIGHT_INFO_MODEL, timeout=LATENCY_BUDGET, max_retries=0)
+    recommendation_llm = ChatOpenAI(model=RECOMMENDATION_MODEL, timeout=LATENCY_BUDGET, max_retries=0)
+    fallback_llm = ChatOpenAI(model=FALLBACK_MODEL, timeout=LATENCY_BUDGET, max_retries=0) if FALLBACK_MODEL else None
+    recommendation_graph = RecommendationGraph(flight_info_llm, recommendation_model=recommendation_llm, fallback_model=fallback_llm,
+                                               fallback_reserve=FALLBACK_RESERVE, flight_info_budget=FLIGHT_INFO_BUDGET,
+                                               flight_search_timeout=LATENCY_BUDGET)
     messages = [HumanMessage(content=user_message)]
-    result = recommendation_graph.graph.invoke({"messages": messages, "chat_id": chat_id, "assessment": poll_data})
-    return result['messages'][-1].content
\ No newline at end of file
+    result = recommendation_graph.graph.invoke({"messages": messages, "chat_id": chat_id, "assessment": poll_data,
+                                                "deadline": start_time + LATENCY_BUDGET, "served_by": {}, "step_latency": {}})
+    logger.info(format_routing_record(chat_id, result, time.monotonic() - start_time))
+    return result['messages'][-1].content
+
+def format_routing_record(chat_id: str, result: Dict[str, Any], latency: float) -> str:
+    """
+    Format which path served each step of a recommendation request as one key=value line.
+    Steps the request didn't reach are reported as "skipped".
+    """
+    served_by = result.get('served_by', {})
+    step_latency = result.get('step_latency', {})
+    fields = [f"chat_id={chat_id}"]
+    for step in ROUTED_STEPS:
+        fields.append(f"{step}={served_by.get(step, 'skipped')}")
+        fields.append(f"{step}_latency={step_latency.get(step, 0.0):.2f}")
+    fields.append(f"latency={latency:.2f}")
+    fields.append(f"budget={LATENCY_BUDGET:.2f}")
+    return "routing " + " ".join(fields)
\ No newline at end of file
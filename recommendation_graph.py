@@ -1,16 +1,20 @@
 import logging
 import operator
 import os
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from datetime import datetime
-from typing import TypedDict, Annotated, Optional, Dict, Any
+from typing import TypedDict, Annotated, Optional, Dict, Any, List, Tuple
 
 from dotenv import load_dotenv
-from langchain_core.messages import AnyMessage, SystemMessage
+from langchain_core.messages import AnyMessage, AIMessage, SystemMessage
 from langchain.prompts import ChatPromptTemplate
+from langchain_core.runnables.config import ContextThreadPoolExecutor
 from langchain_core.tools import ToolException
 from langgraph.graph import StateGraph, END
+from openai import APITimeoutError
 
-from flight_info_tool import FlightInfoTool
+from flight_info_tool import FlightInfoTool, FlightSearchTimeout
 from scheduling_utils import schedule_daily_reminder
 
 # Load environment variables
@@ -20,6 +24,11 @@ _ = load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Shared pool for model and flight search calls, so the graph can stop waiting for them at the deadline.
+# A call that misses its deadline keeps its worker until its own client timeout stops it.
+# The context is copied to the workers so callbacks passed to the graph still see these calls.
+EXTERNAL_CALL_EXECUTOR = ContextThreadPoolExecutor(max_workers=8, thread_name_prefix="external_call")
+
 class RecommendationState(TypedDict):
     messages: Annotated[list[AnyMessage], operator.add]
     recommendation_message: str
@@ -28,6 +37,9 @@ class RecommendationState(TypedDict):
     assessment: Dict[str, str]
     after_tool_stop: bool
     flight_info_request: Dict[str, Any]
+    deadline: Optional[float]
+    served_by: Annotated[dict[str, str], operator.or_]
+    step_latency: Annotated[dict[str, float], operator.or_]
 
 system_message_flight_template = ChatPromptTemplate.from_messages([
     ("system", """You are a flight search assistant. Given user's flight and flight date, call the tool for printing the info about this flight.
@@ -41,6 +53,11 @@ Current date: {current_date}
 """)
 ])
 
+BASE_RECOMMENDATIONS = """🌞 Take 0.5mg melatonin at 10:30pm to help advance your sleep onset
+☕ Avoid caffeine after 3pm
+🌇 Get outdoor light exposure in the morning to help anchor your circadian clock
+🚶‍♂️ Do some light exercise like walking between 5-7pm"""
+
 system_message_recommendation_template = ChatPromptTemplate.from_messages([
     ("system", """You are an expert in designing personalized, science-backed sleep and circadian protocols. 
 Your goal is to create a detailed, tailored plan that addresses an individual's chronotype and preferences, with the aim of enhancing their sleep quality and daytime alertness for dealing with jet lag. 
@@ -48,19 +65,32 @@ Your recommendations should be actionable and time-specific."""),
     ("user", """Based on the provided circadian assessment (user's personal assessment), generate recommendations that are targeting melatonin, caffeine, physical activity, light exposure, sleep onset and offset timing.
 Here is the assessment data: {assessment}.
 Here are the base recommendations. You can use them as a starting point, modify them, or add new ones:
-🌞 Take 0.5mg melatonin at 10:30pm to help advance your sleep onset
-☕ Avoid caffeine after 3pm
-🌇 Get outdoor light exposure in the morning to help anchor your circadian clock
-🚶‍♂️ Do some light exercise like walking between 5-7pm
+""" + BASE_RECOMMENDATIONS + """
 (On your response, don't forget to include emojis and new lines for better readability. DON'T INCLUDE ANY COMMENTS OR EXPLANATIONS OR ADDITIONAL TEXT FORMATTING, OUTPUT ONLY THE LIST OF RECOMMENDATION)
 
 Here is the flight info: {flight_info}""")
 ])
 
+FLIGHT_INFO_TIMEOUT_MESSAGE = ("Sorry, looking up your flight is taking longer than usual. "
+                               "Please send your flight number and date again in a moment.")
+FLIGHT_INFO_ERROR_MESSAGE = "Sorry, the flight search is not available right now. Please try again later."
+
 class RecommendationGraph:
-    def __init__(self, model: Any, flight_info_prompt: ChatPromptTemplate = system_message_flight_template, recommendation_prompt: ChatPromptTemplate = system_message_recommendation_template) -> None:
+    def __init__(self, model: Any, flight_info_prompt: ChatPromptTemplate = system_message_flight_template, recommendation_prompt: ChatPromptTemplate = system_message_recommendation_template,
+                 recommendation_model: Optional[Any] = None, fallback_model: Optional[Any] = None, fallback_reserve: float = 0.0,
+                 flight_info_budget: Optional[float] = None, flight_search_timeout: Optional[float] = None) -> None:
+        """
+        `model` serves the flight-parsing (tool-calling) step and `recommendation_model` (defaults to `model`) the recommendation step.
+        Each step runs until the request deadline, except the flight-parsing step, which is capped at `flight_info_budget` seconds.
+        Within a step, the primary model gets the step's time minus `fallback_reserve` seconds, and `fallback_model` gets what is left.
+        If neither answers, the recommendation step falls back to the base recommendations.
+        The flight search is also stopped at the request deadline. `flight_search_timeout` is the timeout of its HTTP request,
+        which frees the worker of a search the graph stopped waiting for.
+        """
         self.flight_info_prompt = flight_info_prompt
         self.recommendation_prompt = recommendation_prompt
+        self.fallback_reserve = fallback_reserve
+        self.flight_info_budget = flight_info_budget
 
         graph = StateGraph(RecommendationState)
         graph.add_node("llm", self.call_openai_flight_info_state)
@@ -83,9 +113,49 @@ class RecommendationGraph:
 
         graph.set_entry_point("llm")
         self.graph = graph.compile()
-        self.flight_info_tool = FlightInfoTool()
+        self.flight_info_tool = FlightInfoTool(request_timeout=flight_search_timeout)
         self.model = model
         self.model_with_tools = model.bind_tools([self.flight_info_tool])
+        self.recommendation_model = recommendation_model if recommendation_model is not None else model
+        self.fallback_model = fallback_model
+        self.fallback_model_with_tools = fallback_model.bind_tools([self.flight_info_tool]) if fallback_model is not None else None
+
+    def invoke_within_deadline(self, stage: str, candidates: List[Tuple[str, Any]], messages: List[AnyMessage], deadline: Optional[float]) -> Tuple[Optional[Any], str, float]:
+        """
+        Invoke the candidate models in order until one answers before the deadline.
+        Returns the model result, the name of the candidate that served it and the step latency.
+        If no candidate answered, the result is None and the name is "timeout" (some candidate ran out of time) or "error".
+        """
+        start_time = time.monotonic()
+        result, served_by = None, "error"
+        for i, (name, model) in enumerate(candidates):
+            if deadline is None:
+                timeout = None
+            else:
+                timeout = deadline - time.monotonic()
+                if i < len(candidates) - 1:
+                    timeout -= self.fallback_reserve
+                if timeout <= 0:
+                    logger.warning(f"No latency budget left for the {name} model at the {stage} step")
+                    served_by = "timeout"
+                    continue
+                # Stop the HTTP request itself at the deadline, not only the wait for it
+                model = model.bind(timeout=timeout)
+
+            future = EXTERNAL_CALL_EXECUTOR.submit(model.invoke, messages)
+            try:
+                result, served_by = future.result(timeout=timeout), name
+                break
+            except (FutureTimeoutError, APITimeoutError):
+                future.cancel()
+                logger.warning(f"The {name} model timed out at the {stage} step")
+                served_by = "timeout"
+            except Exception:
+                logger.exception(f"The {name} model failed at the {stage} step")
+
+        latency = time.monotonic() - start_time
+        logger.info(f"The {stage} step was served by {served_by} in {latency:.2f}s")
+        return result, served_by, latency
 
     def exists_action_transition(self, state: RecommendationState) -> bool:
         """
@@ -100,16 +170,40 @@ class RecommendationGraph:
         """
         messages = state['messages']
         messages = self.flight_info_prompt.invoke({"chat_id": state["chat_id"], "current_date": datetime.now()}).messages + messages
-        result = self.model_with_tools.invoke(messages)
-        return {'messages': [result]}
+        candidates = [("primary", self.model_with_tools)]
+        if self.fallback_model_with_tools is not None:
+            candidates.append(("fallback", self.fallback_model_with_tools))
+
+        deadline = state.get('deadline')
+        if self.flight_info_budget is not None:
+            step_deadline = time.monotonic() + self.flight_info_budget
+            deadline = step_deadline if deadline is None else min(deadline, step_deadline)
+
+        result, served_by, latency = self.invoke_within_deadline("flight_info", candidates, messages, deadline)
+        if result is None:
+            # There is nothing to build recommendations from without the flight, so ask the user to retry
+            result = AIMessage(content=FLIGHT_INFO_TIMEOUT_MESSAGE if served_by == "timeout" else FLIGHT_INFO_ERROR_MESSAGE)
+        return {'messages': [result], 'served_by': {"flight_info": served_by}, 'step_latency': {"flight_info": latency}}
 
     def call_openai_recommendation_state(self, state: RecommendationState) -> Dict[str, Any]:
         """
         Call the OpenAI model to get personalized recommendations.
+        Falls back to the base recommendations if no model answers before the deadline.
         """
         messages = self.recommendation_prompt.invoke({"assessment": state["assessment"], "flight_info": state['flight_info']}).messages
-        result = self.model.invoke(messages)
-        return {"recommendation_message": result.content}
+        candidates = [("primary", self.recommendation_model)]
+        if self.fallback_model is not None:
+            candidates.append(("fallback", self.fallback_model))
+
+        result, served_by, latency = self.invoke_within_deadline("recommendation", candidates, messages, state.get('deadline'))
+        if result is None:
+            logger.warning(f"No model answered at the recommendation step ({served_by}), using the base recommendations")
+            served_by = "template"
+            recommendation_message = BASE_RECOMMENDATIONS
+        else:
+            recommendation_message = result.content
+        return {"recommendation_message": recommendation_message, 'served_by': {"recommendation": served_by},
+                'step_latency': {"recommendation": latency}}
 
     def schedule_message_state(self, state: RecommendationState) -> Dict[str, Any]:
         """
@@ -140,13 +234,25 @@ class RecommendationGraph:
         tool_call = tool_calls[0]
         if tool_call['name'] != "flight_info_tool":
             raise ValueError("Only flight_info_tool is supported")
+        start_time = time.monotonic()
         try:
+            deadline = state.get('deadline')
+            timeout = None if deadline is None else deadline - start_time
+            if timeout is not None and timeout <= 0:
+                raise FlightSearchTimeout("The flight search took too long.")
             logger.info(f"Invoking flight_info_tool with arguments: {tool_call['args']}")
-            result = self.flight_info_tool.invoke(tool_call['args'])
+            future = EXTERNAL_CALL_EXECUTOR.submit(self.flight_info_tool.invoke, tool_call['args'])
+            try:
+                result = future.result(timeout=timeout)
+            except FutureTimeoutError:
+                future.cancel()
+                raise FlightSearchTimeout("The flight search took too long.")
             logger.info("Found the flight info")
         except ToolException as e:
             logger.error(f"Error during flight info tool invocation: {e}")
-            return {'messages': [SystemMessage(content=f"{e} Please try again.")], 'after_tool_stop': True}
-
-        return {'flight_info': result, 'after_tool_stop': False}
+            served_by = "timeout" if isinstance(e, FlightSearchTimeout) else "error"
+            return {'messages': [SystemMessage(content=f"{e} Please try again.")], 'after_tool_stop': True,
+                    'served_by': {"flight_info_tool": served_by}, 'step_latency': {"flight_info_tool": time.monotonic() - start_time}}
 
+        return {'flight_info': result, 'after_tool_stop': False,
+                'served_by': {"flight_info_tool": "ok"}, 'step_latency': {"flight_info_tool": time.monotonic() - start_time}}
@@ -0,0 +1,122 @@
+import os
+import threading
+import time
+from typing import Any, List, Optional
+
+import pytest
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from langchain_core.messages import AIMessage, AnyMessage
+
+os.environ.setdefault("RAPID_API_KEY", "test")
+os.environ.setdefault("RAPID_API_HOST", "test")
+
+from flight_info_tool import FlightInfoTool
+from recommendation_graph import (BASE_RECOMMENDATIONS, FLIGHT_INFO_ERROR_MESSAGE, FLIGHT_INFO_TIMEOUT_MESSAGE,
+                                  RecommendationGraph)
+
+
+class StubModel:
+    """Model stub that answers, raises, or blocks until the test releases it."""
+    def __init__(self, content: str = "", release: Optional[threading.Event] = None, error: Optional[Exception] = None) -> None:
+        self.content, self.release, self.error = content, release, error
+
+    def bind_tools(self, tools: List[Any]) -> "StubModel":
+        return self
+
+    def bind(self, **kwargs: Any) -> "StubModel":
+        return self
+
+    def invoke(self, messages: List[AnyMessage]) -> AIMessage:
+        if self.release is not None:
+            self.release.wait()
+        if self.error is not None:
+            raise self.error
+        return AIMessage(content=self.content)
+
+
+class FakeToolChatModel(FakeListChatModel):
+    def bind_tools(self, tools: List[Any]) -> "FakeToolChatModel":
+        return self
+
+
+class ChatModelStartCounter(BaseCallbackHandler):
+    def __init__(self) -> None:
+        self.count = 0
+
+    def on_chat_model_start(self, *args: Any, **kwargs: Any) -> None:
+        self.count += 1
+
+
+@pytest.fixture
+def release():
+    # Blocked stubs are released after each test so they don't hold the shared executor
+    event = threading.Event()
+    yield event
+    event.set()
+
+
+def recommendation_state(budget: float) -> dict:
+    return {"messages": [], "chat_id": 1, "assessment": {}, "flight_info": {}, "deadline": time.monotonic() + budget}
+
+
+def graph_input(budget: float) -> dict:
+    return {"messages": [], "chat_id": 1, "assessment": {}, "deadline": time.monotonic() + budget, "served_by": {}, "step_latency": {}}
+
+
+def test_slow_primary_and_fallback_fall_back_to_template(release):
+    slow = StubModel("late answer", release=release)
+    graph = RecommendationGraph(slow, fallback_model=slow, fallback_reserve=0.2)
+    update = graph.call_openai_recommendation_state(recommendation_state(0.5))
+    assert update["recommendation_message"] == BASE_RECOMMENDATIONS
+    assert update["served_by"] == {"recommendation": "template"}
+
+
+def test_slow_primary_falls_back_to_fallback_model(release):
+    graph = RecommendationGraph(StubModel(release=release), fallback_model=StubModel("fallback answer"), fallback_reserve=0.2)
+    update = graph.call_openai_recommendation_state(recommendation_state(0.5))
+    assert update["recommendation_message"] == "fallback answer"
+    assert update["served_by"] == {"recommendation": "fallback"}
+
+
+def test_failing_primary_falls_back_to_fallback_model():
+    graph = RecommendationGraph(StubModel(error=ValueError("bad model")), fallback_model=StubModel("fallback answer"), fallback_reserve=0.2)
+    update = graph.call_openai_recommendation_state(recommendation_state(5))
+    assert update["served_by"] == {"recommendation": "fallback"}
+
+
+def test_primary_is_skipped_when_reserve_exceeds_remaining_budget():
+    graph = RecommendationGraph(StubModel("primary answer"), fallback_model=StubModel("fallback answer"), fallback_reserve=10)
+    update = graph.call_openai_recommendation_state(recommendation_state(5))
+    assert update["served_by"] == {"recommendation": "fallback"}
+
+
+def test_flight_step_is_capped_by_flight_info_budget(release):
+    graph = RecommendationGraph(StubModel(release=release), flight_info_budget=0.2)
+    result = graph.graph.invoke(graph_input(30))
+    assert result["messages"][-1].content == FLIGHT_INFO_TIMEOUT_MESSAGE
+    assert result["served_by"] == {"flight_info": "timeout"}
+
+
+def test_flight_step_errors_are_not_reported_as_timeouts():
+    broken = StubModel(error=ValueError("bad model"))
+    graph = RecommendationGraph(broken, fallback_model=broken)
+    result = graph.graph.invoke(graph_input(30))
+    assert result["messages"][-1].content == FLIGHT_INFO_ERROR_MESSAGE
+    assert result["served_by"] == {"flight_info": "error"}
+
+
+def test_slow_flight_search_stops_at_deadline(release, monkeypatch):
+    monkeypatch.setattr(FlightInfoTool, "_run", lambda self, *args, **kwargs: release.wait())
+    tool_call = AIMessage(content="", tool_calls=[{"name": "flight_info_tool", "args": {"flight_number": "AA100"}, "id": "1"}])
+    graph = RecommendationGraph(StubModel())
+    update = graph.take_action_state({"messages": [tool_call], "deadline": time.monotonic() + 0.2})
+    assert update["after_tool_stop"]
+    assert update["served_by"] == {"flight_info_tool": "timeout"}
+
+
+def test_graph_callbacks_see_model_calls():
+    counter = ChatModelStartCounter()
+    graph = RecommendationGraph(FakeToolChatModel(responses=["Which flight?"]))
+    graph.graph.invoke(graph_input(30), config={"callbacks": [counter]})
+    assert counter.count == 1